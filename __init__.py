@@ -2,15 +2,30 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import contract
+from . import instrumentation
 from . import move
 from . import purchase
+from . import uom
 
 
 def register():
     Pool.register(
         contract.PurchaseContract,
         contract.PurchaseContractLine,
+        contract.PurchaseContractLedgerPending,
         purchase.Purchase,
         purchase.PurchaseLine,
         move.Move,
+        uom.Uom,
+        contract.PurchaseContractLedgerCheckStart,
+        contract.PurchaseContractImportStart,
+        contract.PurchaseContractImportResult,
+        contract.PurchaseContractConsumption,
+        instrumentation.ContractInstrumentation,
+        contract.Cron,
         module='purchase_contract', type_='model')
+    Pool.register(
+        contract.PurchaseContractLedgerCheck,
+        contract.PurchaseContractImport,
+        purchase.AssignContractLines,
+        module='purchase_contract', type_='wizard')
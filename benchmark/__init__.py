@@ -0,0 +1,14 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the purchase contract hot paths.
+
+It activates the module on the test database (configured with the
+TRYTOND_DATABASE_URI and DB_NAME environment variables like the tests),
+generates suppliers, contracts, purchases and moves for each scale and
+reports the wall time and the number of SQL queries of each hot path:
+
+    python -m trytond.modules.purchase_contract.benchmark --scales 1,10
+
+The generated data is rolled back at the end of each scale.
+'''
@@ -0,0 +1,129 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import argparse
+import time
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+
+from ..instrumentation import QueryCounter
+from .data import generate
+
+
+def measure(func):
+    'Return the wall time and the number of queries of calling func'
+    transaction = Transaction()
+    transaction.cache.clear()
+    counter = QueryCounter(transaction.connection)
+    transaction.connection = counter
+    start = time.perf_counter()
+    try:
+        func()
+    finally:
+        transaction.connection = counter.connection
+    return time.perf_counter() - start, counter.count
+
+
+def hot_paths(records):
+    'Yield the name, the number of records and the function of hot paths'
+    pool = Pool()
+    ContractLine = pool.get('purchase.contract.line')
+    Move = pool.get('stock.move')
+    Purchase = pool.get('purchase.purchase')
+    PurchaseLine = pool.get('purchase.line')
+
+    line_ids = [l.id for l in records['contract_lines']]
+    purchase_ids = [p.id for p in records['purchases']]
+    purchase_line_ids = [l.id for l in records['purchase_lines']]
+    move_ids = [m.id for m in records['moves']]
+    names = ['origin_quantity', 'destination_quantity', 'consumed_quantity']
+
+    def get_quantities():
+        ContractLine.get_quantities(ContractLine.browse(line_ids), names)
+
+    def compute_quantities():
+        ContractLine._compute_quantities(line_ids)
+
+    def get_moves():
+        ContractLine.get_moves(ContractLine.browse(line_ids), 'moves')
+
+    def on_change_product():
+        ContractLine._active_line_cache.clear()
+        for line in PurchaseLine.browse(purchase_line_ids):
+            line.on_change_product()
+
+    def validate():
+        Purchase.validate(Purchase.browse(purchase_ids))
+
+    def create_invoice():
+        for purchase in Purchase.browse(purchase_ids):
+            purchase.create_invoice()
+
+    def get_origin_quantity_required():
+        Move.get_origin_quantity_required(
+            Move.browse(move_ids), 'origin_quantity_required')
+
+    yield 'get_quantities', len(line_ids), get_quantities
+    yield 'get_quantities without ledger', len(line_ids), compute_quantities
+    yield 'get_moves', len(line_ids), get_moves
+    yield 'on_change_product', len(purchase_line_ids), on_change_product
+    yield 'Purchase.validate', len(purchase_ids), validate
+    yield 'Purchase.create_invoice', len(purchase_ids), create_invoice
+    yield ('get_origin_quantity_required', len(move_ids),
+        get_origin_quantity_required)
+
+
+def run(scale, options):
+    from trytond.modules.account.tests import create_chart
+    from trytond.modules.company.tests import create_company, set_company
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            start = time.perf_counter()
+            records = generate(
+                suppliers=options.suppliers * scale,
+                contracts=options.contracts,
+                contract_lines=options.contract_lines,
+                purchases=options.purchases,
+                purchase_lines=options.purchase_lines,
+                moves=options.moves)
+            print('scale %s: %s contract lines, %s purchase lines, '
+                '%s moves generated in %.2fs' % (scale,
+                    len(records['contract_lines']),
+                    len(records['purchase_lines']), len(records['moves']),
+                    time.perf_counter() - start))
+            for name, size, func in hot_paths(records):
+                duration, queries = measure(func)
+                print('%-32s %8s records %10.4fs %8s queries' % (
+                        name, size, duration, queries))
+        transaction.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the purchase contract hot paths")
+    parser.add_argument('--scales', default='1,2,4',
+        help="comma separated multipliers of the number of suppliers")
+    parser.add_argument('--suppliers', type=int, default=5)
+    parser.add_argument('--contracts', type=int, default=2,
+        help="contracts per supplier")
+    parser.add_argument('--contract-lines', type=int, default=20,
+        help="lines per contract")
+    parser.add_argument('--purchases', type=int, default=10,
+        help="purchases per supplier")
+    parser.add_argument('--purchase-lines', type=int, default=10,
+        help="lines per purchase")
+    parser.add_argument('--moves', type=int, default=2,
+        help="moves per purchase line")
+    options = parser.parse_args()
+
+    activate_module('purchase_contract')
+    for scale in map(int, options.scales.split(',')):
+        run(scale, options)
+
+
+if __name__ == '__main__':
+    main()
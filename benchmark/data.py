@@ -0,0 +1,172 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+
+def generate(suppliers=5, contracts=2, contract_lines=20, purchases=10,
+        purchase_lines=10, moves=2):
+    '''
+    The company must have a chart of accounts.
+    Create the suppliers with their contracts, the processing purchases that
+    consume the active contracts and their done moves, and build the ledger
+    of the contract lines.
+    The purchases have the accounting setup needed to be invoiced.
+    Return a dictionary with the created records.
+    '''
+    pool = Pool()
+    Account = pool.get('account.account')
+    Category = pool.get('product.category')
+    Company = pool.get('company.company')
+    Contract = pool.get('purchase.contract')
+    ContractLine = pool.get('purchase.contract.line')
+    Date = pool.get('ir.date')
+    ModelData = pool.get('ir.model.data')
+    Move = pool.get('stock.move')
+    Party = pool.get('party.party')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    Purchase = pool.get('purchase.purchase')
+    PurchaseLine = pool.get('purchase.line')
+    Template = pool.get('product.template')
+    purchase_table = Purchase.__table__()
+    cursor = Transaction().connection.cursor()
+
+    today = Date.today()
+    company = Company(Transaction().context['company'])
+    kilogram = ModelData.get_id('product', 'uom_kilogram')
+    gram = ModelData.get_id('product', 'uom_gram')
+    supplier_location = ModelData.get_id('stock', 'location_supplier')
+    storage_location = ModelData.get_id('stock', 'location_storage')
+    warehouse = ModelData.get_id('stock', 'location_warehouse')
+
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ], limit=1)
+    category, = Category.create([{
+                'name': 'Contract Products',
+                'accounting': True,
+                'account_expense': expense.id,
+                }])
+    payment_term, = PaymentTerm.create([{
+                'name': 'Remainder',
+                'lines': [('create', [{'type': 'remainder'}])],
+                }])
+
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'purchasable': True,
+                'account_category': category.id,
+                'default_uom': kilogram,
+                'purchase_uom': gram if i % 2 else kilogram,
+                'list_price': Decimal(10),
+                'products': [('create', [{}])],
+                } for i in range(contract_lines)])
+    products = [t.products[0] for t in templates]
+
+    parties = Party.create([{
+                'name': 'Supplier %s' % i,
+                'addresses': [('create', [{}])],
+                } for i in range(suppliers)])
+
+    to_create = []
+    for party in parties:
+        for i in range(contracts):
+            start_date = today - datetime.timedelta(days=365 * (contracts - i))
+            end_date = None
+            if i < contracts - 1:
+                end_date = start_date + datetime.timedelta(days=364)
+            to_create.append({
+                    'party': party.id,
+                    'contract_type': 'origin' if i % 2 else 'destination',
+                    'invoice_type': 'origin',
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'lines': [('create', [{
+                                    'product': p.id,
+                                    'agreed_quantity': 1000.0,
+                                    'agreed_unit_price': Decimal(5),
+                                    } for p in products])],
+                    })
+    contract_records = Contract.create(to_create)
+    Contract.active(contract_records)
+
+    current_lines = {}
+    for contract in contract_records:
+        if not contract.end_date:
+            for line in contract.lines:
+                current_lines[(contract.party.id, line.product.id)] = line
+
+    to_create = []
+    for party in parties:
+        for i in range(purchases):
+            lines = []
+            for j in range(purchase_lines):
+                product = products[(i + j) % len(products)]
+                contract_line = current_lines[(party.id, product.id)]
+                lines.append({
+                        'type': 'line',
+                        'product': product.id,
+                        'quantity': float(moves),
+                        'unit': product.purchase_uom.id,
+                        'unit_price': Decimal(5),
+                        'description': product.rec_name,
+                        'contract_line': contract_line.id,
+                        })
+            to_create.append({
+                    'party': party.id,
+                    'invoice_address': party.addresses[0].id,
+                    'payment_term': payment_term.id,
+                    'purchase_date': today,
+                    'invoice_method': 'shipment',
+                    'warehouse': warehouse,
+                    'lines': [('create', lines)],
+                    })
+    purchase_records = Purchase.create(to_create)
+    # The purchase workflow is skipped to not create the shipments as the
+    # moves are generated below
+    for sub_ids in grouped_slice(purchase_records):
+        cursor.execute(*purchase_table.update(
+                [purchase_table.state], ['processing'],
+                where=reduce_ids(purchase_table.id, list(map(int, sub_ids)))))
+
+    purchase_line_records = PurchaseLine.search([
+            ('purchase', 'in', [p.id for p in purchase_records]),
+            ])
+    to_create = []
+    for line in purchase_line_records:
+        for i in range(moves):
+            to_create.append({
+                    'product': line.product.id,
+                    'uom': line.unit.id,
+                    'quantity': 1.0,
+                    'origin_uom': line.unit.id,
+                    'origin_quantity': 1.0,
+                    'from_location': supplier_location,
+                    'to_location': storage_location,
+                    'origin': str(line),
+                    'effective_date': today,
+                    'unit_price': Decimal(5),
+                    'currency': company.currency.id,
+                    'company': company.id,
+                    })
+    move_records = Move.create(to_create)
+    Move.do(move_records)
+
+    # The ledger is updated by queued tasks which are not run here
+    contract_line_records = [l for c in contract_records for l in c.lines]
+    ContractLine.rebuild_ledger(contract_line_records)
+
+    return {
+        'parties': parties,
+        'products': products,
+        'contracts': contract_records,
+        'contract_lines': contract_line_records,
+        'purchases': purchase_records,
+        'purchase_lines': purchase_line_records,
+        'moves': move_records,
+        }
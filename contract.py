@@ -1,18 +1,116 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import ModelView, ModelSQL, Workflow, fields, Unique
-from trytond.pool import Pool
+import csv
+import datetime
+import io
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from math import floor, log10
+from weakref import WeakKeyDictionary
+
+from sql import Literal, Null
+from sql.aggregate import Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp, Extract, Floor
+from sql.operators import Exists
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import (
+    ModelView, ModelSQL, Workflow, fields, Unique, Index)
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
 from trytond.modules.product import price_digits
 
-__all__ = ['PurchaseContract', 'PurchaseContractLine']
+from .instrumentation import instrumented
+
+__all__ = ['PurchaseContract', 'PurchaseContractLine',
+    'PurchaseContractLedgerPending', 'PurchaseContractLedgerCheckStart',
+    'PurchaseContractLedgerCheck',
+    'PurchaseContractImportStart', 'PurchaseContractImportResult',
+    'PurchaseContractImport', 'PurchaseContractConsumption', 'Cron']
 
 
 _STATES = {
     'readonly': Eval('state') != 'draft',
     }
 _DEPENDS = ['state']
+# The ids of the contract lines whose ledger is pending per transaction
+_pending_lines = WeakKeyDictionary()
+
+
+def _round_half_even(value):
+    'Return the SQL expression that rounds value half to even like round'
+    lower = Floor(value)
+    fraction = value - lower
+    return Case((fraction > 0.5, lower + 1),
+        (fraction < 0.5, lower),
+        (Floor(lower / 2) * 2 == lower, lower),
+        else_=lower + 1)
+
+
+def compute_qty_sql(quantity, from_uom, to_uom):
+    '''
+    Return the SQL expression that converts quantity from from_uom to to_uom
+    (both product_uom tables) the same way Uom.compute_qty does, including
+    the rounding to the target unit.
+    '''
+    pool = Pool()
+    Uom = pool.get('product.uom')
+
+    conversions = Uom.contract_conversions()
+    factor_ids = [i for i, (_, field, _, _, _) in conversions.items()
+        if field == 'factor']
+    roundings = {}
+    for uom_id, (_, _, _, _, rounding) in conversions.items():
+        roundings.setdefault(rounding, []).append(uom_id)
+
+    def accurate_factor(uom):
+        if factor_ids:
+            return uom.id.in_(factor_ids)
+        return Literal(False)
+
+    amount = Case((accurate_factor(from_uom), quantity * from_uom.factor),
+        else_=quantity / from_uom.rate)
+    amount = Case((accurate_factor(to_uom), amount / to_uom.factor),
+        else_=amount * to_uom.rate)
+    amount = Case((from_uom.id == to_uom.id, quantity), else_=amount)
+
+    # Same operations as product.uom._round to get the same float
+    rounded = []
+    for rounding, uom_ids in roundings.items():
+        if rounding < 1:
+            factor = 10 ** -floor(log10(rounding))
+        else:
+            factor = 1
+        precision = rounding * factor
+        rounded.append((to_uom.id.in_(uom_ids),
+                _round_half_even(amount * factor / precision)
+                * precision / factor))
+    if rounded:
+        amount = Case(*rounded)
+    return Case((from_uom.id == Null, quantity), else_=amount)
+
+
+def _order_quantity(name):
+    @classmethod
+    def order(cls, tables):
+        table, _ = tables[None]
+        if 'quantities' not in tables:
+            quantities = cls._quantities_table()
+            tables['quantities'] = {
+                None: (quantities, quantities.id == table.id),
+                }
+        else:
+            quantities, _ = tables['quantities'][None]
+        return [getattr(quantities, name)]
+    return order
 
 
 class PurchaseContract(Workflow, ModelSQL, ModelView):
@@ -41,10 +139,31 @@ class PurchaseContract(Workflow, ModelSQL, ModelView):
     end_date = fields.Date('End Date', states=_STATES, depends=_DEPENDS)
     lines = fields.One2Many('purchase.contract.line', 'contract', 'Lines',
         states=_STATES, depends=_DEPENDS)
+    consumption_limit = fields.Selection([
+            (None, ''),
+            ('warn', 'Warn'),
+            ('block', 'Block'),
+            ], 'Consumption Limit', states=_STATES, depends=_DEPENDS,
+        help='What to do when a move consumes more than the agreed quantity')
 
     @classmethod
     def __setup__(cls):
         super(PurchaseContract, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.party, Index.Equality()),
+                    (t.state, Index.Equality()),
+                    (t.start_date, Index.Range()),
+                    (t.end_date, Index.Range())),
+                Index(t,
+                    (t.state, Index.Equality()),
+                    (t.start_date, Index.Range())),
+                Index(t,
+                    (t.state, Index.Equality()),
+                    (t.end_date, Index.Range())),
+                Index(t, (t.reference, Index.Similarity())),
+                })
         cls._transitions |= set((
                 ('draft', 'active'),
                 ('active', 'cancelled'),
@@ -58,6 +177,10 @@ class PurchaseContract(Workflow, ModelSQL, ModelView):
                     'invisible': Eval('state') != 'active',
                     'icon': 'tryton-cancel',
                     },
+                'snapshot': {
+                    'invisible': Eval('state') != 'cancelled',
+                    'icon': 'tryton-refresh',
+                    },
                 })
 
     @classmethod
@@ -72,6 +195,27 @@ class PurchaseContract(Workflow, ModelSQL, ModelView):
                 [sql_table.state], ['cancelled'],
                 where=sql_table.state == 'cancel'))
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Line = pool.get('purchase.contract.line')
+        Line._active_line_cache.clear()
+        return super(PurchaseContract, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Line = pool.get('purchase.contract.line')
+        Line._active_line_cache.clear()
+        super(PurchaseContract, cls).write(*args)
+
+    @classmethod
+    def delete(cls, contracts):
+        pool = Pool()
+        Line = pool.get('purchase.contract.line')
+        Line._active_line_cache.clear()
+        super(PurchaseContract, cls).delete(contracts)
+
     @classmethod
     def copy(cls, contracts, default=None):
         pool = Pool()
@@ -85,14 +229,12 @@ class PurchaseContract(Workflow, ModelSQL, ModelView):
         default['start_date'] = None
         default['end_date'] = None
 
-        new_contracts = []
-        for contract in contracts:
-            new_contract, = super(PurchaseContract, cls).copy(
-                [contract], default=default)
-            Line.copy(contract.lines, default={
-                    'contract': new_contract.id,
-                    })
-            new_contracts.append(new_contract)
+        new_contracts = super(PurchaseContract, cls).copy(
+            contracts, default=default)
+        new_ids = dict(zip(map(int, contracts), map(int, new_contracts)))
+        Line.copy([l for c in contracts for l in c.lines], default={
+                'contract': lambda data: new_ids[data['contract']],
+                })
         return new_contracts
 
     @staticmethod
@@ -128,6 +270,188 @@ class PurchaseContract(Workflow, ModelSQL, ModelView):
         Date = Pool().get('ir.date')
         cancels = [c for c in contracts if not c.end_date]
         cls.write(cancels, {'end_date': Date.today()})
+        # The state is written after the transition
+        cls._snapshot(contracts)
+
+    @classmethod
+    @ModelView.button
+    def snapshot(cls, contracts):
+        'Store the final quantities of the lines of the cancelled contracts'
+        cls._snapshot([c for c in contracts if c.state == 'cancelled'])
+
+    @classmethod
+    def _snapshot(cls, contracts):
+        pool = Pool()
+        Line = pool.get('purchase.contract.line')
+        lines = [l for c in contracts for l in c.lines]
+        for sub_lines in grouped_slice(lines):
+            Line.update_snapshot(list(sub_lines))
+
+    @classmethod
+    def process_lifecycle(cls, date=None):
+        '''
+        Activate the draft contracts whose start date has arrived and cancel
+        the active contracts whose end date has passed.
+        The contracts are processed by queued tasks of bounded size.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if date is None:
+            date = Date.today()
+        size = config.getint('purchase_contract', 'lifecycle_batch_size',
+            default=1000)
+
+        contracts = cls.search(['OR', [
+                    ('state', '=', 'draft'),
+                    ('start_date', '<=', date),
+                    ['OR',
+                        ('end_date', '=', None),
+                        ('end_date', '>=', date),
+                        ],
+                    ], [
+                    ('state', '=', 'active'),
+                    ('end_date', '<', date),
+                    ]], order=[('id', 'ASC')])
+        to_activate = [c for c in contracts if c.state == 'draft']
+        to_cancel = [c for c in contracts if c.state == 'active']
+        for sub_contracts in grouped_slice(to_activate, size):
+            cls.__queue__.active(list(sub_contracts))
+        for sub_contracts in grouped_slice(to_cancel, size):
+            cls.__queue__.cancel(list(sub_contracts))
+
+    @classmethod
+    def import_rows(cls, rows, size=1000):
+        '''
+        Create the contracts and their lines from an iterable of dictionaries
+        with the keys: party and product (codes), reference, contract_type,
+        invoice_type, start_date, end_date, agreed_quantity and
+        agreed_unit_price.
+        The rows of the same party and reference are lines of the same draft
+        contract, which is created if it does not exist.
+        The rows are processed by chunks of size and the wrong ones are
+        skipped. Return the number of contracts and lines created and the
+        list of (row number, error message).
+        '''
+        pool = Pool()
+        Line = pool.get('purchase.contract.line')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+
+        parties, products, contracts = {}, {}, {}
+        # (party, reference) and product of the existing and imported lines
+        lines = set()
+        errors = []
+        nb_contracts = nb_lines = 0
+
+        def resolve(Model, codes, cache, domain=None):
+            codes = [c for c in codes if c and c not in cache]
+            for sub_codes in grouped_slice(codes):
+                for record in Model.search([
+                            ('code', 'in', list(sub_codes)),
+                            ] + (domain or [])):
+                    cache[record.code] = record.id
+            for code in codes:
+                cache.setdefault(code, None)
+
+        def parse_selection(field, value):
+            if value and value not in dict(field.selection):
+                raise ValueError(value)
+            return value
+
+        def parse_date(value):
+            return datetime.date.fromisoformat(value) if value else None
+
+        rows = enumerate(rows, 1)
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                break
+            resolve(Party, {r.get('party') for _, r in chunk}, parties)
+            resolve(Product, {r.get('product') for _, r in chunk}, products,
+                [('purchasable', '=', True)])
+
+            keys = {(parties.get(r.get('party')), r.get('reference') or None)
+                for _, r in chunk}
+            keys = {k for k in keys if k[0] and k not in contracts}
+            if keys:
+                existing = {}
+                for contract in cls.search([
+                            ('state', '=', 'draft'),
+                            ('party', 'in', list({k[0] for k in keys})),
+                            ], order=[('id', 'ASC')]):
+                    key = (contract.party.id, contract.reference or None)
+                    if key in keys and key not in contracts:
+                        contracts[key] = contract.id
+                        existing[contract.id] = key
+                for sub_ids in grouped_slice(list(existing.keys())):
+                    for line in Line.search([
+                                ('contract', 'in', list(sub_ids)),
+                                ]):
+                        lines.add(
+                            (existing[line.contract.id], line.product.id))
+
+            new_contracts, new_lines = {}, []
+            for number, row in chunk:
+                party = parties.get(row.get('party'))
+                product = products.get(row.get('product'))
+                if not party:
+                    errors.append((number, gettext(
+                                'purchase_contract.msg_import_party_not_found',
+                                code=row.get('party'))))
+                    continue
+                if not product:
+                    errors.append((number, gettext(
+                                'purchase_contract'
+                                '.msg_import_product_not_found',
+                                code=row.get('product'))))
+                    continue
+                key = (party, row.get('reference') or None)
+                if (key, product) in lines:
+                    errors.append((number, gettext(
+                                'purchase_contract'
+                                '.msg_contract_product_uniq')))
+                    continue
+                try:
+                    line = {
+                        'product': product,
+                        'agreed_quantity': (float(row['agreed_quantity'])
+                            if row.get('agreed_quantity') else None),
+                        'agreed_unit_price': Decimal(
+                            row.get('agreed_unit_price') or 0),
+                        }
+                    if key not in contracts and key not in new_contracts:
+                        new_contracts[key] = {
+                            'party': party,
+                            'reference': key[1],
+                            'contract_type': (parse_selection(
+                                    cls.contract_type,
+                                    row.get('contract_type'))
+                                or cls.default_contract_type()),
+                            'invoice_type': (parse_selection(
+                                    cls.invoice_type,
+                                    row.get('invoice_type'))
+                                or cls.default_invoice_type()),
+                            'start_date': parse_date(row.get('start_date')),
+                            'end_date': parse_date(row.get('end_date')),
+                            }
+                except (ValueError, InvalidOperation) as exception:
+                    errors.append((number, gettext(
+                                'purchase_contract.msg_import_invalid_row',
+                                error=exception)))
+                    continue
+                lines.add((key, product))
+                new_lines.append((key, line))
+
+            if new_contracts:
+                created = cls.create(list(new_contracts.values()))
+                for key, contract in zip(new_contracts.keys(), created):
+                    contracts[key] = contract.id
+                nb_contracts += len(created)
+            for key, line in new_lines:
+                line['contract'] = contracts[key]
+            Line.create([l for _, l in new_lines])
+            nb_lines += len(new_lines)
+        return nb_contracts, nb_lines, errors
 
 
 class PurchaseContractLine(ModelSQL, ModelView):
@@ -146,13 +470,27 @@ class PurchaseContractLine(ModelSQL, ModelView):
     lines = fields.One2Many('purchase.line', 'contract_line',
         'Lines', readonly=True)
     moves = fields.Function(fields.One2Many('stock.move', None, 'Moves',
-        readonly=True), 'get_moves')
+        readonly=True), 'get_moves', searcher='search_moves')
     origin_quantity = fields.Function(fields.Float('Origin Quantity',
-        digits='unit'), 'get_quantities')
+        digits='unit'), 'get_quantities', searcher='search_quantities')
     destination_quantity = fields.Function(fields.Float('Destination Quantity',
-        digits='unit'), 'get_quantities')
+        digits='unit'), 'get_quantities', searcher='search_quantities')
     consumed_quantity = fields.Function(fields.Float('Consumed Quantity',
-        digits='unit'), 'get_quantities')
+        digits='unit'), 'get_quantities', searcher='search_quantities')
+    remaining_quantity = fields.Function(fields.Float('Remaining Quantity',
+        digits='unit'), 'get_quantities', searcher='search_quantities')
+    consumption_ratio = fields.Function(fields.Float('Consumption Ratio',
+        digits=(16, 4)), 'get_quantities', searcher='search_quantities')
+    _active_line_cache = Cache('purchase.contract.line.get_active_line',
+        context=False)
+    ledger_origin_quantity = fields.Float('Ledger Origin Quantity',
+        readonly=True)
+    ledger_destination_quantity = fields.Float('Ledger Destination Quantity',
+        readonly=True)
+    snapshot_origin_quantity = fields.Float('Snapshot Origin Quantity',
+        readonly=True)
+    snapshot_destination_quantity = fields.Float(
+        'Snapshot Destination Quantity', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -162,11 +500,80 @@ class PurchaseContractLine(ModelSQL, ModelView):
             ('contract_product_uniq', Unique(t, t.contract, t.product),
                 'purchase_contract.msg_contract_product_uniq'),
             ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.product, Index.Equality()),
+                (t.contract, Index.Equality())))
+        cls.__rpc__.update({
+                'get_status': RPC(),
+                })
 
-    def get_rec_name(self, name):
-        return '%s, %s, %s %s, %s' % (self.contract.rec_name,
-            self.product.rec_name, self.agreed_quantity, self.unit.symbol,
-            self.agreed_unit_price)
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        super(PurchaseContractLine, cls).__register__(module_name)
+
+        # Build the ledger of the lines created before it existed
+        cursor.execute(*table.select(table.id,
+                where=(table.ledger_origin_quantity == Null)
+                | (table.ledger_destination_quantity == Null)))
+        ids = [i for i, in cursor]
+        for sub_ids in grouped_slice(ids):
+            cls.update_ledger(list(sub_ids))
+
+    @classmethod
+    def get_rec_name(cls, lines, name):
+        result = {}
+        for sub_lines in grouped_slice(lines):
+            for values in cls.read([l.id for l in sub_lines], [
+                        'contract.rec_name', 'product.rec_name',
+                        'agreed_quantity', 'unit.symbol',
+                        'agreed_unit_price']):
+                result[values['id']] = '%s, %s, %s %s, %s' % (
+                    (values['contract.'] or {}).get('rec_name'),
+                    (values['product.'] or {}).get('rec_name'),
+                    values['agreed_quantity'],
+                    (values['unit.'] or {}).get('symbol'),
+                    values['agreed_unit_price'])
+        return result
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        if clause[1].startswith('!') or clause[1].startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        return [bool_op,
+            ('contract.reference',) + tuple(clause[1:]),
+            ('contract.party.name',) + tuple(clause[1:]),
+            ('product.code',) + tuple(clause[1:]),
+            ('product.name',) + tuple(clause[1:]),
+            ]
+
+    @staticmethod
+    def default_ledger_origin_quantity():
+        return 0.0
+
+    @staticmethod
+    def default_ledger_destination_quantity():
+        return 0.0
+
+    @classmethod
+    def create(cls, vlist):
+        cls._active_line_cache.clear()
+        return super(PurchaseContractLine, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._active_line_cache.clear()
+        super(PurchaseContractLine, cls).write(*args)
+
+    @classmethod
+    def delete(cls, lines):
+        cls._active_line_cache.clear()
+        super(PurchaseContractLine, cls).delete(lines)
 
     @classmethod
     def copy(cls, lines, default=None):
@@ -174,9 +581,144 @@ class PurchaseContractLine(ModelSQL, ModelView):
             default = {}
         default = default.copy()
         default['lines'] = None
+        default['ledger_origin_quantity'] = 0.0
+        default['ledger_destination_quantity'] = 0.0
+        default['snapshot_origin_quantity'] = None
+        default['snapshot_destination_quantity'] = None
 
         return super(PurchaseContractLine, cls).copy(lines, default=default)
 
+    @classmethod
+    def get_active_lines(cls, keys):
+        '''
+        Return a dictionary with the line of an active contract (or None) for
+        each (party, product, date) key
+        '''
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        contract = Contract.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def cache_key(key):
+            party, product, date = key
+            return (int(party), int(product), date.isoformat())
+
+        line_ids = {}
+        missing = []
+        for key in keys:
+            line_id = cls._active_line_cache.get(cache_key(key), -1)
+            if line_id == -1:
+                missing.append(key)
+            else:
+                line_ids[key] = line_id
+
+        candidates = {}
+        parties = list({int(k[0]) for k in missing})
+        products = list({int(k[1]) for k in missing})
+        for sub_parties in grouped_slice(parties):
+            sub_parties = list(sub_parties)
+            for sub_products in grouped_slice(products):
+                cursor.execute(*table.join(contract,
+                        condition=table.contract == contract.id
+                        ).select(table.id, contract.party, table.product,
+                        contract.start_date, contract.end_date,
+                        where=(contract.state == 'active')
+                        & reduce_ids(contract.party, sub_parties)
+                        & reduce_ids(table.product, sub_products),
+                        order_by=[table.id]))
+                for line_id, party, product, start, end in cursor:
+                    candidates.setdefault((party, product), []).append(
+                        (line_id, start, end))
+
+        for key in missing:
+            party, product, date = key
+            line_id = None
+            for candidate, start, end in candidates.get(
+                    (int(party), int(product)), []):
+                if ((not start or start <= date)
+                        and (not end or end >= date)):
+                    line_id = candidate
+                    break
+            cls._active_line_cache.set(cache_key(key), line_id)
+            line_ids[key] = line_id
+
+        return {k: cls(i) if i is not None else None
+            for k, i in line_ids.items()}
+
+    @classmethod
+    def _changed_since(cls, date):
+        'Return the query of the lines whose line, contract or moves changed'
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        contract = Contract.__table__()
+        join, move, purchase_line = Move._purchase_line_join()
+
+        moves = join.select(purchase_line.contract_line,
+            where=(purchase_line.contract_line != Null)
+            & (Coalesce(move.write_date, move.create_date) >= date))
+        return table.join(contract,
+            condition=table.contract == contract.id
+            ).select(table.id,
+            where=(Coalesce(table.write_date, table.create_date) >= date)
+            | (Coalesce(contract.write_date, contract.create_date) >= date)
+            | table.id.in_(moves))
+
+    @classmethod
+    def get_status(cls, keys=None, ids=None, changed_since=None, offset=0,
+            limit=None):
+        '''
+        Return the status of the contract lines of the (party, product, date)
+        keys and of the ids (or of all the lines if none is given) ordered by
+        id. If changed_since is set, only the lines whose line, contract or
+        moves changed since that datetime are returned.
+        '''
+        domain = []
+        if keys is not None or ids is not None:
+            line_ids = set(map(int, ids or []))
+            if keys:
+                lines = cls.get_active_lines([tuple(k) for k in keys])
+                line_ids.update(l.id for l in lines.values() if l)
+            domain.append(('id', 'in', list(line_ids)))
+        if changed_since is not None:
+            domain.append(('id', 'in', cls._changed_since(changed_since)))
+        line_ids = [l.id for l in cls.search(domain, offset=offset,
+                limit=limit, order=[('id', 'ASC')])]
+
+        status = []
+        for values in cls.read(line_ids, [
+                    'contract', 'contract.party', 'contract.state',
+                    'contract.start_date', 'contract.end_date', 'product',
+                    'unit', 'agreed_quantity', 'agreed_unit_price',
+                    'consumed_quantity', 'remaining_quantity']):
+            contract = values['contract.']
+            status.append({
+                    'id': values['id'],
+                    'contract': values['contract'],
+                    'party': contract['party'],
+                    'state': contract['state'],
+                    'start_date': contract['start_date'],
+                    'end_date': contract['end_date'],
+                    'product': values['product'],
+                    'unit': values['unit'],
+                    'agreed_quantity': values['agreed_quantity'],
+                    'agreed_unit_price': values['agreed_unit_price'],
+                    'consumed_quantity': values['consumed_quantity'],
+                    'remaining_quantity': values['remaining_quantity'],
+                    })
+        return status
+
+    @classmethod
+    def get_active_line(cls, party, product, date):
+        '''
+        Return the line of an active contract of the party for the product
+        valid at the date or None
+        '''
+        key = (party, product, date)
+        return cls.get_active_lines([key])[key]
+
     @fields.depends('product')
     def on_change_with_unit(self, name=None):
         if self.product:
@@ -187,37 +729,649 @@ class PurchaseContractLine(ModelSQL, ModelView):
     def on_change_with_agreed_unit_price(self):
         return self.product.cost_price if self.product else None
 
-    def get_moves(self, name):
-        moves = []
-        for line in self.lines:
-            if line.purchase.state in ['processing', 'done']:
-                moves.extend([m.id for m in line.moves
-                        if m.state not in ('draft' 'cancelled')])
+    @classmethod
+    def _moves_join(cls):
+        '''
+        Return the join of stock_move with its purchase line and purchase,
+        the purchase line and move tables and the condition of the moves
+        consumed from the contract lines
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Purchase = pool.get('purchase.purchase')
+        purchase = Purchase.__table__()
+
+        join, move, purchase_line = Move._purchase_line_join()
+        join = join.join(purchase,
+            condition=purchase_line.purchase == purchase.id)
+        where = ((purchase_line.contract_line != Null)
+            & purchase.state.in_(['processing', 'done'])
+            & ~move.state.in_(['draft', 'cancelled']))
+        return join, purchase_line, move, where
+
+    @classmethod
+    @instrumented
+    def get_moves(cls, lines, name):
+        cursor = Transaction().connection.cursor()
+        join, purchase_line, move, where = cls._moves_join()
+
+        moves = {l.id: [] for l in lines}
+        for sub_ids in grouped_slice(list(moves.keys())):
+            cursor.execute(*join.select(purchase_line.contract_line, move.id,
+                    where=where
+                    & reduce_ids(purchase_line.contract_line, sub_ids),
+                    order_by=[purchase_line.contract_line, move.id]))
+            for line_id, move_id in cursor:
+                moves[line_id].append(move_id)
         return moves
 
     @classmethod
+    def search_moves(cls, name, clause):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        join, purchase_line, move, where = cls._moves_join()
+
+        nested = clause[0][len(name) + 1:]
+        if clause[1] == 'where':
+            domain = clause[2]
+        elif nested:
+            domain = [(nested,) + tuple(clause[1:])]
+        else:
+            domain = [('id',) + tuple(clause[1:])]
+        moves = Move.search(domain, order=[], query=True)
+        query = join.select(purchase_line.contract_line,
+            where=where & move.id.in_(moves))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def _quantities_query(cls, ids=None, missing_ledger=False):
+        '''
+        Return the query that aggregates the origin, destination and consumed
+        quantities of the contract lines from their moves.
+        The origin quantity is converted to the default unit of the product.
+        If missing_ledger is set only the lines without ledger or with a
+        pending ledger are computed, unless a snapshot of their inactive
+        contract is stored.
+        '''
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        contract = Contract.__table__()
+        contract_line = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+        join, purchase_line, move, where = cls._moves_join()
+
+        if ids is not None:
+            where &= reduce_ids(purchase_line.contract_line, ids)
+        if missing_ledger:
+            where &= ((contract_line.ledger_origin_quantity == Null)
+                | (contract_line.ledger_destination_quantity == Null)
+                | cls._ledger_pending(contract_line))
+            where &= ((contract_line.snapshot_origin_quantity == Null)
+                | (contract_line.snapshot_destination_quantity == Null)
+                | (contract.state == 'active'))
+
+        origin = Sum(compute_qty_sql(
+                move.origin_quantity, from_uom, to_uom))
+        destination = Sum(move.internal_quantity)
+        return (join
+            .join(contract_line,
+                condition=purchase_line.contract_line == contract_line.id)
+            .join(contract, condition=contract_line.contract == contract.id)
+            .join(product, condition=move.product == product.id)
+            .join(template, condition=product.template == template.id)
+            .join(to_uom, condition=template.default_uom == to_uom.id)
+            .join(from_uom, 'LEFT', condition=move.origin_uom == from_uom.id)
+            .select(
+                purchase_line.contract_line.as_('id'),
+                origin.as_('origin_quantity'),
+                destination.as_('destination_quantity'),
+                Case((contract.contract_type == 'origin', origin),
+                    else_=destination).as_('consumed_quantity'),
+                where=where,
+                group_by=[purchase_line.contract_line,
+                    contract.contract_type]))
+
+    @classmethod
+    def _quantities_table(cls):
+        '''
+        Return the query with the quantities of all the contract lines.
+        The remaining quantity and the consumption ratio are expressed in the
+        unit of the line.
+        '''
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        table = cls.__table__()
+        contract = Contract.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        default_uom = Uom.__table__()
+        purchase_uom = Uom.__table__()
+        computed = cls._quantities_query(missing_ledger=True)
+
+        pending = cls._ledger_pending(table)
+        active = contract.state == 'active'
+        origin = Coalesce(
+            Case((active, Null), else_=table.snapshot_origin_quantity),
+            Case((pending, Null), else_=table.ledger_origin_quantity),
+            computed.origin_quantity, 0.0)
+        destination = Coalesce(
+            Case((active, Null), else_=table.snapshot_destination_quantity),
+            Case((pending, Null), else_=table.ledger_destination_quantity),
+            computed.destination_quantity, 0.0)
+        consumed = Case((contract.contract_type == 'origin', origin),
+            else_=destination)
+        consumed_unit = compute_qty_sql(consumed, default_uom, purchase_uom)
+        return (table
+            .join(contract, condition=table.contract == contract.id)
+            .join(computed, 'LEFT', condition=computed.id == table.id)
+            .join(product, condition=table.product == product.id)
+            .join(template, condition=product.template == template.id)
+            .join(default_uom,
+                condition=template.default_uom == default_uom.id)
+            .join(purchase_uom,
+                condition=template.purchase_uom == purchase_uom.id)
+            .select(
+                table.id.as_('id'),
+                origin.as_('origin_quantity'),
+                destination.as_('destination_quantity'),
+                consumed.as_('consumed_quantity'),
+                (table.agreed_quantity - consumed_unit).as_(
+                    'remaining_quantity'),
+                Case((table.agreed_quantity != 0,
+                        consumed_unit / table.agreed_quantity),
+                    else_=Null).as_('consumption_ratio'),
+                ))
+
+    @classmethod
+    def search_quantities(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        quantities = cls._quantities_table()
+        query = quantities.select(quantities.id,
+            where=Operator(getattr(quantities, name), value))
+        return [('id', 'in', query)]
+
+    order_origin_quantity = _order_quantity('origin_quantity')
+    order_destination_quantity = _order_quantity('destination_quantity')
+    order_consumed_quantity = _order_quantity('consumed_quantity')
+    order_remaining_quantity = _order_quantity('remaining_quantity')
+    order_consumption_ratio = _order_quantity('consumption_ratio')
+
+    @classmethod
+    def _compute_quantities(cls, ids):
+        '''
+        Return the quantities of the contract lines computed from all their
+        moves
+        '''
+        cursor = Transaction().connection.cursor()
+
+        res = {}
+        for line_id in ids:
+            res[line_id] = {
+                'origin_quantity': 0.0,
+                'destination_quantity': 0.0,
+                'consumed_quantity': 0.0,
+                }
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*cls._quantities_query(list(sub_ids)))
+            for line_id, origin, destination, consumed in cursor:
+                res[line_id] = {
+                    'origin_quantity': origin or 0.0,
+                    'destination_quantity': destination or 0.0,
+                    'consumed_quantity': consumed or 0.0,
+                    }
+        return res
+
+    @classmethod
+    @instrumented
     def get_quantities(cls, lines, names):
         pool = Pool()
+        Contract = pool.get('purchase.contract')
         Uom = pool.get('product.uom')
+        contract = Contract.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
 
         res = {}
         line_ids = [l.id for l in lines]
         for name in names:
             res[name] = {}.fromkeys(line_ids, 0.0)
 
-        for line in lines:
-            origin = destination = 0.0
-            for move in line.moves:
-                origin += Uom.compute_qty(move.origin_uom,
-                    move.origin_quantity, to_uom=move.product.default_uom)
-                destination += move.internal_quantity
-            if 'origin_quantity' in names:
-                res['origin_quantity'][line.id] = origin
-            if 'destination_quantity' in names:
-                res['destination_quantity'][line.id] = destination
-            if 'consumed_quantity' in names:
-                if line.contract.contract_type == 'origin':
-                    res['consumed_quantity'][line.id] = origin
-                else:
-                    res['consumed_quantity'][line.id] = destination
+        quantities = {}
+        missing = []
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.join(contract,
+                    condition=table.contract == contract.id
+                    ).select(table.id, table.ledger_origin_quantity,
+                    table.ledger_destination_quantity,
+                    table.snapshot_origin_quantity,
+                    table.snapshot_destination_quantity,
+                    contract.contract_type, contract.state,
+                    cls._ledger_pending(table),
+                    where=reduce_ids(table.id, sub_ids)))
+            for (line_id, origin, destination, snapshot_origin,
+                    snapshot_destination, contract_type, state,
+                    pending) in cursor:
+                if (state != 'active'
+                        and snapshot_origin is not None
+                        and snapshot_destination is not None):
+                    origin, destination = (
+                        snapshot_origin, snapshot_destination)
+                elif pending:
+                    origin = destination = None
+                if origin is None or destination is None:
+                    missing.append(line_id)
+                    continue
+                quantities[line_id] = {
+                    'origin_quantity': origin,
+                    'destination_quantity': destination,
+                    'consumed_quantity': (origin
+                        if contract_type == 'origin' else destination),
+                    }
+        if missing:
+            quantities.update(cls._compute_quantities(missing))
+
+        if {'remaining_quantity', 'consumption_ratio'} & set(names):
+            lines_by_units = {}
+            for line in lines:
+                values = quantities[line.id]
+                values['remaining_quantity'] = None
+                values['consumption_ratio'] = None
+                if line.agreed_quantity is not None:
+                    key = (line.product.default_uom.id, line.unit.id)
+                    lines_by_units.setdefault(key, []).append(line)
+            for (from_uom, to_uom), units_lines in lines_by_units.items():
+                consumed_quantities = Uom.compute_qtys(from_uom,
+                    [quantities[l.id]['consumed_quantity']
+                        for l in units_lines], to_uom)
+                for line, consumed in zip(units_lines, consumed_quantities):
+                    values = quantities[line.id]
+                    values['remaining_quantity'] = (
+                        line.agreed_quantity - consumed)
+                    if line.agreed_quantity:
+                        values['consumption_ratio'] = (
+                            consumed / line.agreed_quantity)
+
+        for line_id, values in quantities.items():
+            for name in names:
+                res[name][line_id] = values[name]
         return res
+
+    @classmethod
+    def update_ledger(cls, lines):
+        '''
+        Store on the ledger the quantities of the contract lines computed
+        from their moves
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = list({int(l) for l in lines})
+        for line_id, values in cls._compute_quantities(ids).items():
+            cursor.execute(*table.update(
+                    [table.ledger_origin_quantity,
+                        table.ledger_destination_quantity],
+                    [values['origin_quantity'],
+                        values['destination_quantity']],
+                    where=table.id == line_id))
+
+    @classmethod
+    def update_snapshot(cls, lines):
+        '''
+        Store on the snapshot the quantities of the contract lines computed
+        from their moves, which are then used instead of the ledger
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = list({int(l) for l in lines})
+        for line_id, values in cls._compute_quantities(ids).items():
+            cursor.execute(*table.update(
+                    [table.snapshot_origin_quantity,
+                        table.snapshot_destination_quantity],
+                    [values['origin_quantity'],
+                        values['destination_quantity']],
+                    where=table.id == line_id))
+
+    @classmethod
+    def _ledger_pending(cls, table):
+        'Return the condition of the lines of table with a pending ledger'
+        pool = Pool()
+        Pending = pool.get('purchase.contract.ledger.pending')
+        pending = Pending.__table__()
+        return Exists(pending.select(pending.id,
+                where=pending.line == table.id))
+
+    @classmethod
+    def invalidate_ledger(cls, lines):
+        '''
+        Mark the ledger of the contract lines as pending and queue its update
+
+        The contract lines are not written so concurrent transactions do not
+        conflict. Their quantities are computed from the moves until the
+        queued task updates the ledger. A line is marked and queued only once
+        per transaction.
+        '''
+        pool = Pool()
+        Pending = pool.get('purchase.contract.ledger.pending')
+        pending = Pending.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        marked = _pending_lines.setdefault(transaction, set())
+        ids = sorted({int(l) for l in lines} - marked)
+        marked.update(ids)
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*pending.insert(
+                    [pending.line, pending.create_uid, pending.create_date],
+                    [[i, transaction.user, CurrentTimestamp()]
+                        for i in sub_ids]))
+            cls.__queue__.process_ledger(cls.browse(sub_ids))
+
+    @classmethod
+    def process_ledger(cls, lines):
+        '''
+        Update the ledger of the pending lines queued by invalidate_ledger
+
+        Only the pending marks read before computing the quantities are
+        removed so the changes committed meanwhile are processed by their own
+        task.
+        '''
+        pool = Pool()
+        Pending = pool.get('purchase.contract.ledger.pending')
+        pending = Pending.__table__()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice(list({int(l) for l in lines})):
+            cursor.execute(*pending.select(pending.line, Max(pending.id),
+                    where=reduce_ids(pending.line, list(sub_ids)),
+                    group_by=[pending.line]))
+            last_ids = dict(cursor)
+            if not last_ids:
+                continue
+            for line_id, values in cls._compute_quantities(
+                    list(last_ids)).items():
+                cursor.execute(*table.update(
+                        [table.ledger_origin_quantity,
+                            table.ledger_destination_quantity],
+                        [values['origin_quantity'],
+                            values['destination_quantity']],
+                        where=table.id == line_id))
+                cursor.execute(*pending.delete(
+                        where=(pending.line == line_id)
+                        & (pending.id <= last_ids[line_id])))
+
+    @classmethod
+    def verify_ledger(cls, lines=None):
+        '''
+        Return the contract lines whose ledger does not match the quantities
+        computed from their moves.
+        The lines without ledger or with a pending ledger are skipped.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if lines is None:
+            lines = cls.search([])
+        wrong = []
+        for sub_lines in grouped_slice(lines):
+            sub_ids = [l.id for l in sub_lines]
+            cursor.execute(*table.select(table.id,
+                    table.ledger_origin_quantity,
+                    table.ledger_destination_quantity,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.ledger_origin_quantity != Null)
+                    & (table.ledger_destination_quantity != Null)
+                    & ~cls._ledger_pending(table)))
+            ledgers = {i: (o, d) for i, o, d in cursor}
+            quantities = cls._compute_quantities(list(ledgers))
+            for line_id, (origin, destination) in ledgers.items():
+                values = quantities[line_id]
+                if (origin != values['origin_quantity']
+                        or destination != values['destination_quantity']):
+                    wrong.append(line_id)
+        return cls.browse(sorted(wrong))
+
+    @classmethod
+    def rebuild_ledger(cls, lines=None):
+        'Recompute the ledger of the contract lines from all their moves'
+        if lines is None:
+            lines = cls.search([])
+        for sub_lines in grouped_slice(lines):
+            cls.update_ledger(list(sub_lines))
+
+
+class PurchaseContractLedgerPending(ModelSQL):
+    'Purchase Contract Ledger Pending'
+    __name__ = 'purchase.contract.ledger.pending'
+    line = fields.Many2One('purchase.contract.line', 'Line', required=True,
+        ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super(PurchaseContractLedgerPending, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.line, Index.Equality())))
+
+
+class PurchaseContractLedgerCheckStart(ModelView):
+    'Check Purchase Contract Ledger'
+    __name__ = 'purchase.contract.ledger.check.start'
+
+    lines = fields.Many2Many('purchase.contract.line', None, None,
+        'Lines with Wrong Ledger', readonly=True)
+
+
+class PurchaseContractLedgerCheck(Wizard):
+    'Check Purchase Contract Ledger'
+    __name__ = 'purchase.contract.ledger.check'
+
+    start = StateView('purchase.contract.ledger.check.start',
+        'purchase_contract.ledger_check_start_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            Button('Rebuild', 'rebuild', 'tryton-refresh', default=True),
+            ])
+    rebuild = StateTransition()
+
+    def default_start(self, fields):
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+        return {
+            'lines': [l.id for l in ContractLine.verify_ledger()],
+            }
+
+    def transition_rebuild(self):
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+        ContractLine.rebuild_ledger()
+        return 'end'
+
+
+class PurchaseContractImportStart(ModelView):
+    'Import Purchase Contracts'
+    __name__ = 'purchase.contract.import.start'
+
+    file_ = fields.Binary('File', required=True)
+    file_format = fields.Selection([
+            ('csv', 'CSV'),
+            ('json', 'JSON'),
+            ], 'Format', required=True,
+        help='CSV with a header row or JSON as a list of objects or one '
+        'object per line')
+
+    @staticmethod
+    def default_file_format():
+        return 'csv'
+
+
+class PurchaseContractImportResult(ModelView):
+    'Import Purchase Contracts'
+    __name__ = 'purchase.contract.import.result'
+
+    contracts = fields.Integer('Contracts Created', readonly=True)
+    lines = fields.Integer('Lines Created', readonly=True)
+    errors = fields.Text('Errors', readonly=True)
+
+
+class PurchaseContractImport(Wizard):
+    'Import Purchase Contracts'
+    __name__ = 'purchase.contract.import'
+
+    start = StateView('purchase.contract.import.start',
+        'purchase_contract.import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('purchase.contract.import.result',
+        'purchase_contract.import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def _rows(self):
+        data = io.TextIOWrapper(io.BytesIO(self.start.file_),
+            encoding='utf-8-sig')
+        if self.start.file_format == 'csv':
+            yield from csv.DictReader(data)
+        elif data.read(1) == '[':
+            data.seek(0)
+            yield from json.load(data)
+        else:
+            data.seek(0)
+            for line in data:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+    def transition_import_(self):
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        rows = ({k: self._value(v) for k, v in row.items()}
+            for row in self._rows())
+        contracts, lines, errors = Contract.import_rows(rows)
+        self.result.contracts = contracts
+        self.result.lines = lines
+        self.result.errors = '\n'.join(
+            '%s: %s' % (number, error) for number, error in errors)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'contracts': self.result.contracts,
+            'lines': self.result.lines,
+            'errors': self.result.errors,
+            }
+
+
+class PurchaseContractConsumption(ModelSQL, ModelView):
+    'Purchase Contract Consumption'
+    __name__ = 'purchase.contract.consumption'
+
+    contract = fields.Many2One('purchase.contract', 'Contract', readonly=True)
+    contract_line = fields.Many2One('purchase.contract.line', 'Contract Line',
+        readonly=True)
+    party = fields.Many2One('party.party', 'Supplier', readonly=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    year = fields.Integer('Year', readonly=True)
+    month = fields.Integer('Month', readonly=True)
+    agreed_quantity = fields.Float('Agreed Quantity', readonly=True)
+    agreed_unit_price = fields.Numeric('Agreed Unit Price',
+        digits=price_digits, readonly=True)
+    origin_quantity = fields.Float('Origin Quantity', readonly=True)
+    destination_quantity = fields.Float('Destination Quantity',
+        readonly=True)
+    consumed_quantity = fields.Float('Consumed Quantity', readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+    amount = fields.Numeric('Amount', digits='currency', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PurchaseContractConsumption, cls).__setup__()
+        cls._order = [
+            ('year', 'DESC'),
+            ('month', 'DESC'),
+            ('party', 'ASC'),
+            ('product', 'ASC'),
+            ]
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        ContractLine = pool.get('purchase.contract.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        contract = Contract.__table__()
+        contract_line = ContractLine.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+        join, purchase_line, move, where = ContractLine._moves_join()
+
+        date = Coalesce(move.effective_date, move.planned_date)
+        year = cls.year.sql_cast(Extract('YEAR', date))
+        month = cls.month.sql_cast(Extract('MONTH', date))
+        origin = Sum(compute_qty_sql(move.origin_quantity, from_uom, to_uom))
+        destination = Sum(move.internal_quantity)
+        return (join
+            .join(contract_line,
+                condition=purchase_line.contract_line == contract_line.id)
+            .join(contract, condition=contract_line.contract == contract.id)
+            .join(product, condition=move.product == product.id)
+            .join(template, condition=product.template == template.id)
+            .join(to_uom, condition=template.default_uom == to_uom.id)
+            .join(from_uom, 'LEFT', condition=move.origin_uom == from_uom.id)
+            .select(
+                Min(move.id).as_('id'),
+                Literal(0).as_('create_uid'),
+                CurrentTimestamp().as_('create_date'),
+                cls.write_uid.sql_cast(Literal(Null)).as_('write_uid'),
+                cls.write_date.sql_cast(Literal(Null)).as_('write_date'),
+                contract.id.as_('contract'),
+                contract_line.id.as_('contract_line'),
+                contract.party.as_('party'),
+                contract_line.product.as_('product'),
+                year.as_('year'),
+                month.as_('month'),
+                Max(contract_line.agreed_quantity).as_('agreed_quantity'),
+                Max(contract_line.agreed_unit_price).as_(
+                    'agreed_unit_price'),
+                origin.as_('origin_quantity'),
+                destination.as_('destination_quantity'),
+                Case((contract.contract_type == 'origin', origin),
+                    else_=destination).as_('consumed_quantity'),
+                move.currency.as_('currency'),
+                Sum(move.unit_price * move.quantity).as_('amount'),
+                where=where,
+                group_by=[contract.id, contract_line.id, contract.party,
+                    contract_line.product, contract.contract_type,
+                    year, month, move.currency]))
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('purchase.contract|process_lifecycle',
+                "Process Purchase Contracts"))
@@ -0,0 +1,146 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+import functools
+import logging
+import time
+import uuid
+from weakref import WeakKeyDictionary
+
+from trytond.config import config
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['ContractInstrumentation', 'instrumented']
+
+logger = logging.getLogger(__name__)
+_statistics = WeakKeyDictionary()
+
+
+def enabled():
+    return (config.getboolean('purchase_contract', 'instrumentation',
+            default=False)
+        or Transaction().context.get('purchase_contract_instrumentation',
+            False))
+
+
+class QueryCounter(object):
+    'Connection wrapper that counts the executed queries'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self, self.connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def instrumented(func):
+    '''
+    Decorate a method to record per transaction its number of calls, of
+    records processed, of SQL queries and its elapsed time
+    '''
+    @functools.wraps(func)
+    def wrapper(self_or_cls, *args, **kwargs):
+        if not enabled():
+            return func(self_or_cls, *args, **kwargs)
+        name = '%s.%s' % (self_or_cls.__name__, func.__name__)
+        records = 1
+        if (isinstance(self_or_cls, type) and args
+                and isinstance(args[0], (list, tuple))):
+            records = len(args[0])
+
+        transaction = Transaction()
+        counter = transaction.connection
+        installed = not isinstance(counter, QueryCounter)
+        if installed:
+            counter = transaction.connection = QueryCounter(counter)
+        queries = counter.count
+        start = time.perf_counter()
+        try:
+            return func(self_or_cls, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            if installed:
+                transaction.connection = counter.connection
+            _record(transaction, name, records, counter.count - queries,
+                duration)
+    return wrapper
+
+
+def _record(transaction, name, records, queries, duration):
+    if transaction not in _statistics:
+        _statistics[transaction] = {}
+        transaction.atexit(_flush, transaction.database.name,
+            transaction.user, _statistics[transaction])
+    values = _statistics[transaction].setdefault(name, [0, 0, 0, 0.0])
+    values[0] += 1
+    values[1] += records
+    values[2] += queries
+    values[3] += duration
+
+
+def _flush(database_name, user, statistics):
+    key = str(uuid.uuid4())
+    for name, (calls, records, queries, duration) in statistics.items():
+        logger.info('%s %s: %s calls, %s records, %s queries, %.4fs',
+            key, name, calls, records, queries, duration)
+    try:
+        with Transaction(new=True).start(database_name, 0):
+            pool = Pool()
+            Instrumentation = pool.get('purchase.contract.instrumentation')
+            Instrumentation.create([{
+                        'transaction': key,
+                        'user': user,
+                        'date': datetime.datetime.now(),
+                        'method': name,
+                        'calls': calls,
+                        'records': records,
+                        'queries': queries,
+                        'duration': round(duration, 4),
+                        } for name, (calls, records, queries, duration)
+                    in statistics.items()])
+    except Exception:
+        logger.warning('Could not store instrumentation of %s', key,
+            exc_info=True)
+
+
+class ContractInstrumentation(ModelSQL, ModelView):
+    'Purchase Contract Instrumentation'
+    __name__ = 'purchase.contract.instrumentation'
+
+    transaction = fields.Char('Transaction', readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True)
+    date = fields.DateTime('Date', readonly=True)
+    method = fields.Char('Method', readonly=True)
+    calls = fields.Integer('Calls', readonly=True)
+    records = fields.Integer('Records', readonly=True)
+    queries = fields.Integer('Queries', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 4), readonly=True,
+        help='Elapsed time in seconds')
+
+    @classmethod
+    def __setup__(cls):
+        super(ContractInstrumentation, cls).__setup__()
+        cls._order.insert(0, ('duration', 'DESC'))
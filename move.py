@@ -1,8 +1,15 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from sql import Cast, Null
+from sql.operators import Concat
+
+from trytond.exceptions import UserError, UserWarning
+from trytond.i18n import gettext
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import And, Eval
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
 from trytond.modules.stock.move import STATES
 
 __all__ = ['Move']
@@ -20,7 +27,8 @@ class Move(metaclass=PoolMeta):
 
     origin_quantity_required = fields.Function(
         fields.Boolean('Origin Quantity Required'),
-        'get_origin_quantity_required')
+        'get_origin_quantity_required',
+        searcher='search_origin_quantity_required')
     origin_uom = fields.Many2One("product.uom", "Origin Uom", domain=[
             ('category', '=', Eval('product_uom_category')),
             ], states=ORIGIN_STATES,
@@ -30,10 +38,148 @@ class Move(metaclass=PoolMeta):
         states=ORIGIN_STATES,
         depends=['state', 'origin_quantity_required'])
 
-    def get_origin_quantity_required(self, name):
-        PurchaseLine = Pool().get('purchase.line')
-        return (self.origin and isinstance(self.origin, PurchaseLine)
-            and self.origin.contract_line and True or False)
+    @classmethod
+    def _purchase_line_join(cls):
+        '''
+        Return the join between stock_move and the purchase_line of its
+        origin with both tables
+        '''
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        move = cls.__table__()
+        purchase_line = PurchaseLine.__table__()
+        varchar = Transaction().database.sql_type('VARCHAR').base
+
+        join = move.join(purchase_line,
+            condition=move.origin == Concat(
+                'purchase.line,', Cast(purchase_line.id, varchar)))
+        return join, move, purchase_line
+
+    @classmethod
+    def _contract_line_ids(cls, moves, counted=False):
+        '''
+        Return the ids of the contract lines the moves are consumed from.
+        If counted is set, the draft and cancelled moves are skipped.
+        '''
+        cursor = Transaction().connection.cursor()
+        join, move, purchase_line = cls._purchase_line_join()
+
+        where = purchase_line.contract_line != Null
+        if counted:
+            where &= ~move.state.in_(['draft', 'cancelled'])
+        line_ids = set()
+        for sub_ids in grouped_slice(list({int(m) for m in moves})):
+            cursor.execute(*join.select(purchase_line.contract_line,
+                    where=reduce_ids(move.id, sub_ids) & where,
+                    group_by=[purchase_line.contract_line]))
+            line_ids.update(l for l, in cursor)
+        return line_ids
+
+    @classmethod
+    def _contract_ledger_fields(cls):
+        return {'state', 'product', 'quantity', 'uom', 'internal_quantity',
+            'origin', 'origin_quantity', 'origin_uom'}
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+        moves = super(Move, cls).create(vlist)
+        to_update = [m for m in moves
+            if m.state not in ('draft', 'cancelled')]
+        if to_update:
+            ContractLine.invalidate_ledger(cls._contract_line_ids(to_update))
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+
+        moves = []
+        counted_changed = False
+        ledger_fields = cls._contract_ledger_fields()
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if ledger_fields & set(values):
+                moves.extend(records)
+                counted_changed |= bool({'origin', 'state'} & set(values))
+        line_ids = set()
+        if moves:
+            line_ids = cls._contract_line_ids(moves, counted=True)
+        super(Move, cls).write(*args)
+        if counted_changed:
+            line_ids |= cls._contract_line_ids(moves, counted=True)
+        if line_ids:
+            ContractLine.invalidate_ledger(line_ids)
+
+    @classmethod
+    def do(cls, moves):
+        super(Move, cls).do(moves)
+        cls.check_contract_consumption(moves)
+
+    @classmethod
+    def check_contract_consumption(cls, moves):
+        '''
+        Warn or block when the moves make their contract lines consume more
+        than their agreed quantity, following the limit of the contract
+        '''
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+        Warning = pool.get('res.user.warning')
+
+        line_ids = cls._contract_line_ids(moves)
+        if not line_ids:
+            return
+        lines = [l for l in ContractLine.browse(list(line_ids))
+            if l.contract.consumption_limit
+            and l.agreed_quantity is not None]
+        if not lines:
+            return
+        remaining = ContractLine.get_quantities(lines,
+            ['remaining_quantity'])['remaining_quantity']
+        exceeded = [l for l in lines if remaining[l.id] < 0]
+        for limit in ['block', 'warn']:
+            limit_lines = [l for l in exceeded
+                if l.contract.consumption_limit == limit]
+            if not limit_lines:
+                continue
+            line = limit_lines[0]
+            message = gettext(
+                'purchase_contract.msg_contract_over_consumption',
+                line=line.rec_name,
+                quantity=line.unit.round(-remaining[line.id]),
+                unit=line.unit.symbol)
+            if limit == 'block':
+                raise UserError(message)
+            key = Warning.format('contract_over_consumption', limit_lines)
+            if Warning.check(key):
+                raise UserWarning(key, message)
+
+    @classmethod
+    def get_origin_quantity_required(cls, moves, name):
+        cursor = Transaction().connection.cursor()
+        join, move, purchase_line = cls._purchase_line_join()
+
+        required = dict.fromkeys([m.id for m in moves], False)
+        for sub_ids in grouped_slice(list(required.keys())):
+            cursor.execute(*join.select(move.id,
+                    where=reduce_ids(move.id, sub_ids)
+                    & (purchase_line.contract_line != Null)))
+            for move_id, in cursor:
+                required[move_id] = True
+        return required
+
+    @classmethod
+    def search_origin_quantity_required(cls, name, clause):
+        _, operator, value = clause
+        join, move, purchase_line = cls._purchase_line_join()
+
+        query = join.select(move.id,
+            where=purchase_line.contract_line != Null)
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
 
     @fields.depends('origin_quantity_required', 'origin_quantity', 'product',
         'uom')
@@ -1,18 +1,34 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from weakref import WeakKeyDictionary
+
+from sql import Cast, Null
+from sql.aggregate import Sum
+from sql.operators import Concat, Exists
+
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Date, Eval, Or
-from trytond.exceptions import UserError
-from trytond.i18n import gettext
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateTransition
+
+from .contract import compute_qty_sql
+from .instrumentation import instrumented
+
+__all__ = ['Purchase', 'PurchaseLine', 'AssignContractLines']
 
-__all__ = ['Purchase', 'PurchaseLine']
+# The origin invoice quantities of the purchases being invoiced per
+# transaction
+_invoice_quantities = WeakKeyDictionary()
 
 
 class Purchase(metaclass=PoolMeta):
     __name__ = 'purchase.purchase'
     has_contract_lines = fields.Function(fields.Boolean('Has Contract Lines?'),
-        'on_change_with_has_contract_lines')
+        'get_has_contract_lines', searcher='search_has_contract_lines')
 
     @classmethod
     def __setup__(cls):
@@ -32,25 +48,128 @@ class Purchase(metaclass=PoolMeta):
             return False
         return any(getattr(l, 'contract_line') for l in self.lines)
 
+    @classmethod
+    def _has_contract_lines_exists(cls, purchase):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        purchase_line = PurchaseLine.__table__()
+        return Exists(purchase_line.select(purchase_line.id,
+                where=(purchase_line.purchase == purchase.id)
+                & (purchase_line.contract_line != Null)))
+
+    @classmethod
+    def get_has_contract_lines(cls, purchases, name):
+        purchase = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice(list(map(int, purchases))):
+            cursor.execute(*purchase.select(purchase.id,
+                    cls._has_contract_lines_exists(purchase),
+                    where=reduce_ids(purchase.id, sub_ids)))
+            result.update((i, bool(v)) for i, v in cursor)
+        return result
+
+    @classmethod
+    def search_has_contract_lines(cls, name, clause):
+        purchase = cls.__table__()
+        _, operator, value = clause
+        exists = cls._has_contract_lines_exists(purchase)
+        if (operator == '=') != bool(value):
+            exists = ~exists
+        return [('id', 'in', purchase.select(purchase.id, where=exists))]
+
+    @classmethod
+    def _contract_line_ids(cls, purchases):
+        'Return the ids of the contract lines used by the purchases'
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        purchase_line = PurchaseLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = set()
+        for sub_ids in grouped_slice(list({int(p) for p in purchases})):
+            cursor.execute(*purchase_line.select(purchase_line.contract_line,
+                    where=reduce_ids(purchase_line.purchase, sub_ids)
+                    & (purchase_line.contract_line != Null),
+                    group_by=[purchase_line.contract_line]))
+            line_ids.update(l for l, in cursor)
+        return line_ids
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+
+        purchases = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'state' in values:
+                purchases.extend(records)
+        super(Purchase, cls).write(*args)
+        if purchases:
+            line_ids = cls._contract_line_ids(purchases)
+            if line_ids:
+                ContractLine.invalidate_ledger(line_ids)
+
     @classmethod
     def validate(cls, purchases):
         super(Purchase, cls).validate(purchases)
-        for purchase in purchases:
-            purchase.check_contract_line_dates()
+        cls.check_contract_line_dates(purchases)
 
-    def check_contract_line_dates(self):
-        for line in self.lines:
-            if not line.contract_line:
-                continue
-            contract = line.contract_line.contract
-            if (contract.start_date
-                    and self.purchase_date < contract.start_date
-                    or contract.end_date
-                    and self.purchase_date > contract.end_date):
+    @classmethod
+    def validate_fields(cls, purchases, field_names):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        super(Purchase, cls).validate_fields(purchases, field_names)
+        if 'invoice_method' in field_names:
+            PurchaseLine.check_invoice_method_with_contract(
+                purchases=purchases)
+
+    def create_invoice(self):
+        purchases = _invoice_quantities.setdefault(Transaction(), {})
+        purchases[self.id] = None
+        try:
+            return super(Purchase, self).create_invoice()
+        finally:
+            purchases.pop(self.id, None)
+
+    @classmethod
+    @instrumented
+    def check_contract_line_dates(cls, purchases):
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        ContractLine = pool.get('purchase.contract.line')
+        PurchaseLine = pool.get('purchase.line')
+        purchase = cls.__table__()
+        purchase_line = PurchaseLine.__table__()
+        contract_line = ContractLine.__table__()
+        contract = Contract.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice(list(map(int, purchases))):
+            cursor.execute(*purchase_line
+                .join(purchase,
+                    condition=purchase_line.purchase == purchase.id)
+                .join(contract_line,
+                    condition=purchase_line.contract_line == contract_line.id)
+                .join(contract,
+                    condition=contract_line.contract == contract.id)
+                .select(purchase_line.id,
+                    where=reduce_ids(purchase.id, sub_ids)
+                    & (((contract.start_date != Null)
+                            & (purchase.purchase_date < contract.start_date))
+                        | ((contract.end_date != Null)
+                            & (purchase.purchase_date > contract.end_date))),
+                    order_by=[purchase_line.purchase, purchase_line.id],
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                line = PurchaseLine(row[0])
                 raise UserError(gettext('purchase_contract.'
                         'msg_invalid_contract_dates',
-                        purchase=self.rec_name,
-                        contract=contract.rec_name,
+                        purchase=line.purchase.rec_name,
+                        contract=line.contract_line.contract.rec_name,
                         line=line.rec_name,
                         ))
 
@@ -85,19 +204,84 @@ class PurchaseLine(metaclass=PoolMeta):
         cls.unit.on_change.add('contract_line')
 
     @classmethod
-    def validate(cls, lines):
-        super(PurchaseLine, cls).validate(lines)
-        cls.check_invoice_method_with_contract(lines)
+    def validate_fields(cls, lines, field_names):
+        super(PurchaseLine, cls).validate_fields(lines, field_names)
+        if {'contract_line', 'purchase'} & field_names:
+            cls.check_invoice_method_with_contract(lines)
 
     @classmethod
-    def check_invoice_method_with_contract(cls, lines):
-        for line in lines:
-            if (line.contract_line
-                    and line.purchase.invoice_method != 'shipment'):
+    @instrumented
+    def check_invoice_method_with_contract(cls, lines=None, purchases=None):
+        '''
+        Check that the purchases of the lines (or the purchases) with
+        contract lines are invoiced based on shipment
+        '''
+        pool = Pool()
+        Purchase = pool.get('purchase.purchase')
+        purchase = Purchase.__table__()
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if lines is not None:
+            column, records = line.id, lines
+        else:
+            column, records = purchase.id, purchases
+        for sub_ids in grouped_slice(list(map(int, records))):
+            cursor.execute(*line.join(purchase,
+                    condition=line.purchase == purchase.id
+                    ).select(purchase.id,
+                    where=reduce_ids(column, sub_ids)
+                    & (line.contract_line != Null)
+                    & (purchase.invoice_method != 'shipment'),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                purchase_id, = row
                 raise UserError(gettext('purchase_contract.'
                         'msg_invalid_invoice_method',
-                        purchase=line.purchase.rec_name))
+                        purchase=Purchase(purchase_id).rec_name))
+
+    @classmethod
+    def assign_contract_lines(cls, lines):
+        '''
+        Set the line of the active contract and its agreed unit price to the
+        lines of draft purchases
+        '''
+        pool = Pool()
+        ContractLine = pool.get('purchase.contract.line')
+        Date = pool.get('ir.date')
+        Uom = pool.get('product.uom')
+        today = Date.today()
+
+        lines_by_key = {}
+        for line in lines:
+            if (line.type != 'line' or not line.product
+                    or line.purchase.state != 'draft'
+                    or not line.purchase.party):
+                continue
+            key = (line.purchase.party.id, line.product.id,
+                line.purchase.purchase_date or today)
+            lines_by_key.setdefault(key, []).append(line)
 
+        contract_lines = ContractLine.get_active_lines(lines_by_key.keys())
+        prices = {}
+        to_save = []
+        for key, key_lines in lines_by_key.items():
+            contract_line = contract_lines[key]
+            if not contract_line:
+                continue
+            for line in key_lines:
+                price_key = (contract_line.id, line.unit)
+                if price_key not in prices:
+                    prices[price_key], = Uom.compute_prices(
+                        contract_line.unit, [contract_line.agreed_unit_price],
+                        line.unit)
+                line.contract_line = contract_line
+                line.unit_price = prices[price_key]
+                to_save.append(line)
+        cls.save(to_save)
+
+    @instrumented
     def on_change_product(self):
         pool = Pool()
         ContractLines = pool.get('purchase.contract.line')
@@ -106,25 +290,12 @@ class PurchaseLine(metaclass=PoolMeta):
 
         super(PurchaseLine, self).on_change_product()
         if self.purchase and self.purchase.party and self.product is not None:
-            lines = ContractLines.search([
-                    ('contract.party', '=', self.purchase.party),
-                    ('product', '=', self.product),
-                    ('contract.state', '=', 'active'),
-                    ['OR',
-                        ('contract.start_date', '=', None),
-                        ('contract.start_date', '<=',
-                            self.purchase.purchase_date or Date.today()),
-                        ],
-                    ['OR',
-                        ('contract.end_date', '=', None),
-                        ('contract.end_date', '>=',
-                            self.purchase.purchase_date or Date.today()),
-                        ],
-                    ], limit=1)
-            if lines:
-                self.contract_line = lines[0]
-                self.unit_price = Uom.compute_price(lines[0].unit,
-                    lines[0].agreed_unit_price, self.unit)
+            line = ContractLines.get_active_line(self.purchase.party,
+                self.product, self.purchase.purchase_date or Date.today())
+            if line:
+                self.contract_line = line
+                self.unit_price, = Uom.compute_prices(line.unit,
+                    [line.agreed_unit_price], self.unit)
 
     @fields.depends('_parent_contract_line.id', 'contract_line')
     def on_change_quantity(self):
@@ -133,12 +304,88 @@ class PurchaseLine(metaclass=PoolMeta):
 
         super(PurchaseLine, self).on_change_quantity()
         if self.contract_line:
-            self.unit_price = Uom.compute_price(self.contract_line.unit,
-                    self.contract_line.agreed_unit_price, self.unit)
+            self.unit_price, = Uom.compute_prices(self.contract_line.unit,
+                [self.contract_line.agreed_unit_price], self.unit)
 
-    def get_invoice_line(self):
+    @classmethod
+    def get_contract_invoice_quantities(cls, lines):
+        '''
+        Return for each line the origin quantity of its done moves and the
+        quantity already invoiced, excluding recreated invoices, both in the
+        unit of the line
+        '''
         pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        Move = pool.get('stock.move')
+        Purchase = pool.get('purchase.purchase')
+        Recreated = pool.get(Purchase.invoices_recreated.relation_name)
         Uom = pool.get('product.uom')
+        invoice_line = InvoiceLine.__table__()
+        move = Move.__table__()
+        purchase_line = cls.__table__()
+        recreated = Recreated.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+        cursor = Transaction().connection.cursor()
+        varchar = Transaction().database.sql_type('VARCHAR').base
+
+        origin = Concat('purchase.line,', Cast(purchase_line.id, varchar))
+        recreated_invoices = recreated.select(
+            getattr(recreated, Purchase.invoices_recreated.target),
+            where=getattr(recreated, Purchase.invoices_recreated.origin)
+            == purchase_line.purchase)
+
+        quantities = {l.id: {'moved': 0.0, 'invoiced': 0.0} for l in lines}
+        for sub_ids in grouped_slice(list(quantities.keys())):
+            sub_ids = list(sub_ids)
+            cursor.execute(*purchase_line
+                .join(move, condition=move.origin == origin)
+                .join(to_uom, condition=purchase_line.unit == to_uom.id)
+                .join(from_uom, 'LEFT',
+                    condition=move.origin_uom == from_uom.id)
+                .select(purchase_line.id,
+                    Sum(compute_qty_sql(
+                            move.origin_quantity, from_uom, to_uom)),
+                    where=reduce_ids(purchase_line.id, sub_ids)
+                    & (move.state == 'done'),
+                    group_by=[purchase_line.id]))
+            for line_id, quantity in cursor:
+                quantities[line_id]['moved'] = quantity or 0.0
+
+            cursor.execute(*purchase_line
+                .join(invoice_line, condition=invoice_line.origin == origin)
+                .join(to_uom, condition=purchase_line.unit == to_uom.id)
+                .join(from_uom, 'LEFT',
+                    condition=invoice_line.unit == from_uom.id)
+                .select(purchase_line.id,
+                    Sum(compute_qty_sql(
+                            invoice_line.quantity, from_uom, to_uom)),
+                    where=reduce_ids(purchase_line.id, sub_ids)
+                    & (invoice_line.type == 'line')
+                    & ((invoice_line.invoice == Null)
+                        | ~invoice_line.invoice.in_(recreated_invoices)),
+                    group_by=[purchase_line.id]))
+            for line_id, quantity in cursor:
+                quantities[line_id]['invoiced'] = quantity or 0.0
+        return quantities
+
+    @instrumented
+    def _get_contract_invoice_quantities(self):
+        '''
+        Return the origin invoice quantities of the line, prefetched for all
+        the contract lines of the purchase while it is invoiced
+        '''
+        purchases = _invoice_quantities.get(Transaction(), {})
+        if self.purchase.id not in purchases:
+            return self.get_contract_invoice_quantities([self])[self.id]
+        quantities = purchases[self.purchase.id]
+        if quantities is None or self.id not in quantities:
+            quantities = purchases[self.purchase.id] = (
+                self.get_contract_invoice_quantities(
+                    [l for l in self.purchase.lines if l.contract_line]))
+        return quantities[self.id]
+
+    def get_invoice_line(self):
         lines = super(PurchaseLine, self).get_invoice_line()
         if len(lines) != 1:
             return lines
@@ -148,19 +395,21 @@ class PurchaseLine(metaclass=PoolMeta):
         if (contract and contract.invoice_type == 'origin' and
                 self.purchase.invoice_method == 'shipment' and self.product
                 and self.product.type != 'service'):
-            quantity = 0.0
-            for move in self.moves:
-                if move.state == 'done':
-                    quantity += Uom.compute_qty(move.origin_uom,
-                        move.origin_quantity, self.unit)
-            skip_ids = set(l.id for i in self.purchase.invoices_recreated
-                for l in i.lines)
-            for old_invoice_line in self.invoice_lines:
-                if old_invoice_line.type != 'line':
-                    continue
-                if old_invoice_line.id not in skip_ids:
-                    quantity -= Uom.compute_qty(old_invoice_line.unit,
-                            old_invoice_line.quantity, self.unit)
-            line.quantity = quantity
+            quantities = self._get_contract_invoice_quantities()
+            line.quantity = quantities['moved'] - quantities['invoiced']
 
         return [line]
+
+
+class AssignContractLines(Wizard):
+    'Assign Contract Lines'
+    __name__ = 'purchase.purchase.assign_contract_lines'
+    start_state = 'assign'
+    assign = StateTransition()
+
+    def transition_assign(self):
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        PurchaseLine.assign_contract_lines(
+            [l for p in self.records for l in p.lines])
+        return 'end'
@@ -48,6 +48,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     packages=[
         'trytond.modules.%s' % MODULE,
         'trytond.modules.%s.tests' % MODULE,
+        'trytond.modules.%s.benchmark' % MODULE,
         ],
     package_data={
         'trytond.modules.%s' % MODULE: (info.get('xml', [])
@@ -2,13 +2,157 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+from decimal import Decimal
+from unittest.mock import patch
+
+from sql import Literal
+
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.modules.purchase_contract.contract import compute_qty_sql
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class PurchaseContractTestCase(CompanyTestMixin, ModuleTestCase):
     'Test PurchaseContract module'
     module = 'purchase_contract'
 
+    @with_transaction()
+    def test_compute_qty_sql(self):
+        'Test compute_qty_sql gives the same result as compute_qty'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+        cursor = Transaction().connection.cursor()
+
+        uoms = Uom.browse([ModelData.get_id('product', n) for n in [
+                    'uom_unit', 'uom_gram', 'uom_kilogram', 'uom_meter',
+                    'uom_centimeter', 'uom_inch']])
+        quantities = [0, 0.5, 1.5, 2.5, 5, 7.5, 12.345, 0.125, 0.005, 1005,
+            -2.5, 3.14159]
+        for from_ in uoms:
+            for to in uoms:
+                if from_.category != to.category:
+                    continue
+                for quantity in quantities:
+                    cursor.execute(*from_uom.join(to_uom,
+                            condition=to_uom.id == to.id
+                            ).select(compute_qty_sql(
+                                Literal(quantity), from_uom, to_uom),
+                            where=from_uom.id == from_.id))
+                    result, = cursor.fetchone()
+                    self.assertEqual(result,
+                        Uom.compute_qty(from_, quantity, to),
+                        msg='%s %s to %s' % (
+                            quantity, from_.symbol, to.symbol))
+
+    @with_transaction()
+    def test_compute_qtys_prices(self):
+        'Test compute_qtys and compute_prices give the same result'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        uoms = Uom.search([])
+        quantities = [0, 0.5, 1.5, 2.5, 5, 7.5, 12.345, 0.125, 0.005, 1005,
+            -2.5, 3.14159]
+        prices = [Decimal(0), Decimal('0.5'), Decimal('1.2345'), Decimal(5),
+            Decimal('7.5'), Decimal('1005'), Decimal('-2.5')]
+        for from_ in uoms:
+            for to in uoms:
+                if from_.category != to.category:
+                    continue
+                msg = '%s to %s' % (from_.symbol, to.symbol)
+                self.assertEqual(Uom.compute_qtys(from_, quantities, to),
+                    [Uom.compute_qty(from_, q, to) for q in quantities],
+                    msg=msg)
+                self.assertEqual(Uom.compute_prices(from_, prices, to),
+                    [Uom.compute_price(from_, p, to) for p in prices],
+                    msg=msg)
+
+    @with_transaction()
+    def test_ledger_invalidated_while_processing(self):
+        'Test the ledger stays pending if invalidated while processed'
+        pool = Pool()
+        Contract = pool.get('purchase.contract')
+        ContractLine = pool.get('purchase.contract.line')
+        ModelData = pool.get('ir.model.data')
+        Party = pool.get('party.party')
+        Pending = pool.get('purchase.contract.ledger.pending')
+        Queue = pool.get('ir.queue')
+        Template = pool.get('product.template')
+        unit = ModelData.get_id('product', 'uom_unit')
+
+        party, = Party.create([{'name': 'Supplier'}])
+        template, = Template.create([{
+                    'name': 'Product',
+                    'default_uom': unit,
+                    'purchasable': True,
+                    'purchase_uom': unit,
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        contract, = Contract.create([{
+                    'party': party.id,
+                    'lines': [('create', [{
+                                    'product': product.id,
+                                    'agreed_quantity': 10,
+                                    'agreed_unit_price': Decimal(5),
+                                    }])],
+                    }])
+        line, = contract.lines
+
+        ContractLine.invalidate_ledger([line])
+        ContractLine.invalidate_ledger([line])
+        self.assertEqual(len(Queue.search([
+                        ('data.method', '=', 'process_ledger'),
+                        ])), 1)
+        self.assertEqual(len(Pending.search([('line', '=', line.id)])), 1)
+        ContractLine.write([line], {'ledger_origin_quantity': 42.0})
+        self.assertEqual(ContractLine.verify_ledger([line]), [])
+
+        compute_quantities = ContractLine._compute_quantities
+
+        def concurrent_change(ids):
+            result = compute_quantities(ids)
+            # Mark of a change committed by another transaction
+            Pending.create([{'line': i} for i in ids])
+            return result
+
+        with patch.object(ContractLine, '_compute_quantities',
+                side_effect=concurrent_change):
+            ContractLine.process_ledger([line])
+        self.assertEqual(len(Pending.search([('line', '=', line.id)])), 1)
+        values, = ContractLine.read([line.id], ['ledger_origin_quantity'])
+        self.assertEqual(values['ledger_origin_quantity'], 0.0)
+
+        ContractLine.process_ledger([line])
+        self.assertEqual(Pending.search([('line', '=', line.id)]), [])
+        self.assertEqual(ContractLine.verify_ledger([line]), [])
+        ContractLine.write([line], {'ledger_origin_quantity': 42.0})
+        self.assertEqual(ContractLine.verify_ledger([line]), [line])
+
+    def test_instrumentation(self):
+        'Test instrumentation is stored at the end of the transaction'
+        @with_transaction(context={'purchase_contract_instrumentation': True})
+        def compute():
+            pool = Pool()
+            Line = pool.get('purchase.contract.line')
+            Line.get_quantities([], ['origin_quantity'])
+
+        @with_transaction()
+        def check():
+            pool = Pool()
+            Instrumentation = pool.get('purchase.contract.instrumentation')
+            instrumentation, = Instrumentation.search([
+                    ('method', '=', 'purchase.contract.line.get_quantities'),
+                    ])
+            self.assertEqual(instrumentation.calls, 1)
+
+        compute()
+        check()
+
 
 del ModuleTestCase
@@ -0,0 +1,135 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from decimal import Decimal
+
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+from trytond.modules.product.uom import uom_conversion_digits
+
+__all__ = ['Uom']
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+    _contract_conversion_cache = Cache('product.uom.contract_conversions',
+        context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._contract_conversion_cache.clear()
+        return super(Uom, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._contract_conversion_cache.clear()
+        super(Uom, cls).write(*args)
+
+    @classmethod
+    def delete(cls, uoms):
+        cls._contract_conversion_cache.clear()
+        super(Uom, cls).delete(uoms)
+
+    @classmethod
+    def contract_conversions(cls):
+        '''
+        Return for each unit id its category id, accurate field, factor, rate
+        and rounding
+        '''
+        values = cls._contract_conversion_cache.get('conversions')
+        if values is None:
+            with Transaction().set_context(active_test=False):
+                uoms = cls.search([])
+            values = [(u.id, u.category.id, u.accurate_field, u.factor,
+                    u.rate, u.rounding) for u in uoms]
+            cls._contract_conversion_cache.set('conversions', values)
+        return {v[0]: v[1:] for v in values}
+
+    @classmethod
+    def _contract_conversion(cls, from_uom, to_uom):
+        conversions = cls.contract_conversions()
+        from_values = conversions[int(from_uom)]
+        to_values = conversions[int(to_uom)]
+        if from_values[0] != to_values[0]:
+            raise ValueError("cannot convert between units %s and %s "
+                "of different categories" % (int(from_uom), int(to_uom)))
+        return from_values, to_values
+
+    @classmethod
+    def compute_qtys(cls, from_uom, quantities, to_uom, round=True):
+        '''
+        Convert the quantities from from_uom to to_uom with the same result
+        as compute_qty for each one but using the cached conversions
+        '''
+        quantities = list(quantities)
+        if not any(quantities) or (from_uom is None and to_uom is None):
+            return quantities
+        if from_uom is None:
+            raise ValueError("missing from_uom")
+        if to_uom is None:
+            raise ValueError("missing to_uom")
+        (_, from_field, from_factor, from_rate, _), (
+            _, to_field, to_factor, to_rate, to_rounding) = (
+            cls._contract_conversion(from_uom, to_uom))
+        target = cls(int(to_uom), rounding=to_rounding)
+
+        result = []
+        for qty in quantities:
+            if not qty:
+                result.append(qty)
+                continue
+            if from_field == 'factor':
+                amount = qty * from_factor
+            else:
+                amount = qty / from_rate
+            if to_field == 'factor':
+                amount = amount / to_factor
+            else:
+                amount = amount * to_rate
+            if round:
+                amount = target.round(amount)
+            result.append(amount)
+        return result
+
+    @classmethod
+    def compute_prices(cls, from_uom, prices, to_uom):
+        '''
+        Convert the prices from from_uom to to_uom with the same result as
+        compute_price for each one but using the cached conversions
+        '''
+        prices = list(prices)
+        if not any(prices) or (from_uom is None and to_uom is None):
+            return prices
+        if from_uom is None:
+            raise ValueError("missing from_uom")
+        if to_uom is None:
+            raise ValueError("missing to_uom")
+        (_, from_field, from_factor, from_rate, _), (
+            _, to_field, to_factor, to_rate, _) = (
+            cls._contract_conversion(from_uom, to_uom))
+
+        format_ = '%%.%df' % uom_conversion_digits[1]
+        if from_field == 'factor':
+            from_value = Decimal(format_ % from_factor)
+        else:
+            from_value = Decimal(format_ % from_rate)
+        if to_field == 'factor':
+            to_value = Decimal(format_ % to_factor)
+        else:
+            to_value = Decimal(format_ % to_rate)
+
+        result = []
+        for price in prices:
+            if not price:
+                result.append(price)
+                continue
+            if from_field == 'factor':
+                new_price = price / from_value
+            else:
+                new_price = price * from_value
+            if to_field == 'factor':
+                new_price = new_price * to_value
+            else:
+                new_price = new_price / to_value
+            result.append(new_price)
+        return result